@@ -0,0 +1,359 @@
+"""
+Model fitting for the Prophet forecasting script
+
+Per-product fitting runs in joblib worker processes. Keeping it in an importable
+module means workers import these functions, and the module-level Prophet template,
+instead of receiving fresh copies pickled by value from __main__ for every task.
+"""
+
+import pandas as pd
+import numpy as np
+from prophet import Prophet
+from numba import njit
+import logging
+import copy
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging():
+    """Set up INFO logging; a no-op if the process has already configured it"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+@njit(cache=True, fastmath=True)
+def _stats_kernel(y, yhat):
+    """
+    Compute MAE and MAPE (in percent) in a single pass
+    
+    Args:
+        y (np.ndarray): Actual values
+        yhat (np.ndarray): Predicted values
+        
+    Returns:
+        tuple: (mae, mape)
+    """
+    n = y.shape[0]
+    s_abs = 0.0
+    s_pct = 0.0
+    for i in range(n):
+        d = abs(y[i] - yhat[i])
+        s_abs += d
+        s_pct += d / (y[i] if y[i] > 1 else 1.0)
+    return s_abs / n, s_pct * 100.0 / n
+
+
+@njit(cache=True, fastmath=True)
+def _cap_outliers(y, starts):
+    """
+    Cap values beyond 3 standard deviations above the mean, in place
+    
+    Args:
+        y (np.ndarray): Values for all products, grouped contiguously by product
+        starts (np.ndarray): Index of the first value of each product in y
+    """
+    n_groups = starts.shape[0]
+    for g in range(n_groups):
+        start = starts[g]
+        end = starts[g + 1] if g + 1 < n_groups else y.shape[0]
+        count = end - start
+        if count < 2:
+            continue
+        
+        mean = 0.0
+        for i in range(start, end):
+            mean += y[i]
+        mean /= count
+        
+        var = 0.0
+        for i in range(start, end):
+            var += (y[i] - mean) ** 2
+        threshold = mean + 3 * np.sqrt(var / (count - 1))
+        
+        # Branch-free min so the loop compiles to a single SIMD pass
+        for i in range(start, end):
+            y[i] = min(y[i], threshold)
+
+
+# Unfitted Prophet model that each process copies for every fit
+_prophet_template = None
+
+
+def _new_prophet_model(n_records, include_bounds):
+    """
+    Create an unfitted Prophet model by copying a per-process template
+    
+    The copy shares the template's loaded Stan backend, so it is only loaded
+    once per worker rather than once per product.
+    
+    Args:
+        n_records (int): Number of history records the model will be fit on
+        include_bounds (bool): Whether predict should sample uncertainty intervals
+        
+    Returns:
+        Prophet: Fresh model ready to fit
+    """
+    global _prophet_template
+    if _prophet_template is None:
+        _prophet_template = Prophet(
+            daily_seasonality=False,  # Data is daily, so there is no intra-day cycle to fit
+            seasonality_mode='multiplicative',
+            changepoint_prior_scale=0.1,  # Controls flexibility of trend
+            seasonality_prior_scale=10.0,  # Controls flexibility of seasonality
+            interval_width=0.8,  # Uncertainty interval width
+            stan_backend='CMDSTANPY'
+        )
+    
+    # Deep copy so fit state is not shared, except for the Stan backend
+    stan_backend = _prophet_template.stan_backend
+    model = copy.deepcopy(_prophet_template, {id(stan_backend): stan_backend})
+    model.weekly_seasonality = True if n_records >= 14 else False
+    model.yearly_seasonality = True if n_records > 365 else False
+    model.uncertainty_samples = 1000 if include_bounds else 0
+    return model
+
+
+def _cumulative_totals(future_forecast, include_bounds):
+    """
+    Running totals of a Prophet forecast over its future rows
+    
+    Args:
+        future_forecast (pd.DataFrame): Future rows of a Prophet forecast
+        include_bounds (bool): Whether the forecast has yhat_lower/yhat_upper
+    
+    Returns:
+        tuple: Cumulative (yhat, lower, upper) arrays; the bounds equal yhat
+            when include_bounds is False
+    """
+    cs_yhat = future_forecast['yhat'].cumsum().to_numpy()
+    if not include_bounds:
+        return cs_yhat, cs_yhat, cs_yhat
+    
+    cs_lower = future_forecast['yhat_lower'].cumsum().to_numpy()
+    cs_upper = future_forecast['yhat_upper'].cumsum().to_numpy()
+    return cs_yhat, cs_lower, cs_upper
+
+
+def _fill_daily_gaps(product_data):
+    """
+    Reindex a product's history to every day in its range, with no sales as 0
+    
+    Args:
+        product_data (pd.DataFrame): Cleaned sales data with 'ds' and 'y' columns
+    
+    Returns:
+        pd.DataFrame: 'ds' and 'y' columns with one row per calendar day
+    """
+    days = pd.date_range(product_data['ds'].iloc[0], product_data['ds'].iloc[-1], freq='D')
+    return (
+        product_data.set_index('ds')['y']
+        .reindex(days, fill_value=0)
+        .rename_axis('ds')
+        .reset_index()
+    )
+
+
+def naive_forecast(product_data, forecast_periods=[7, 30, 90, 365]):
+    """
+    Forecast from the mean of the last 28 days, without fitting a model
+    
+    Args:
+        product_data (pd.DataFrame): Cleaned sales data with 'ds' and 'y' columns
+        forecast_periods (list): List of periods to forecast
+    
+    Returns:
+        dict: Dictionary in the same shape as train_and_forecast
+    """
+    # Average over calendar days, counting days without sales as 0, so sparse
+    # histories are not overstated; shorter histories use the days they cover
+    y = _fill_daily_gaps(product_data)['y'].to_numpy(dtype=np.float32, copy=True)
+    tail_mean = y[-28:].mean()
+    
+    forecasts = {}
+    for period in forecast_periods:
+        value = round(tail_mean * period)
+        forecasts[f'forecast_{period}d'] = {
+            'value': value,
+            'lower_bound': value,
+            'upper_bound': value
+        }
+    
+    mae, mape = _stats_kernel(y, np.full_like(y, tail_mean))
+    logger.info(f"Used naive baseline for {len(product_data)} records over {len(y)} days. MAE: {mae:.2f}, MAPE: {mape:.2f}%")
+    
+    return {
+        'forecasts': forecasts,
+        'trend_status': 'stable',
+        'confidence_score': 0.3,
+        'mae': mae,
+        'mape': mape
+    }
+
+
+def train_and_forecast(product_data, forecast_periods=[7, 30, 90, 365], include_bounds=False):
+    """
+    Train Prophet model and generate forecasts
+    
+    Args:
+        product_data (pd.DataFrame): Cleaned sales data with 'ds' and 'y' columns
+        forecast_periods (list): List of periods to forecast
+        include_bounds (bool): Compute uncertainty intervals; when False Prophet
+            skips its Monte Carlo sampling and the bounds equal the forecast.
+            Off by default since only the point forecasts are saved
+    
+    Returns:
+        dict: Dictionary containing forecasts and model performance metrics
+    """
+    try:
+        # Too little history for Prophet to learn seasonality; use a
+        # naive baseline of the recent daily average instead
+        if len(product_data) < 90:
+            return naive_forecast(product_data, forecast_periods)
+        
+        # Sparse daily history spends most of a long-horizon fit on zeros, so
+        # long histories forecast 90/365 days from weekly totals instead
+        if len(product_data) > 180:
+            daily_periods = [period for period in forecast_periods if period <= 30]
+        else:
+            daily_periods = list(forecast_periods)
+        weekly_periods = [period for period in forecast_periods if period not in daily_periods]
+        
+        # Initialize Prophet model with reasonable parameters
+        model = _new_prophet_model(len(product_data), include_bounds)
+        
+        # Fit the model
+        logger.info("Training Prophet model...")
+        model.fit(product_data.astype({'y': np.float64}))
+        
+        # Predict once at the longest daily horizon; shorter horizons are prefixes of it
+        horizon = max(daily_periods, default=30)
+        future = model.make_future_dataframe(periods=horizon, freq='D')
+        forecast = model.predict(future)
+        
+        # Totals for each period as (value, lower bound, upper bound)
+        period_totals = {}
+        
+        # Cumulative totals over the future rows, e.g. row 6 is the 7-day total
+        cs_yhat, cs_lower, cs_upper = _cumulative_totals(
+            forecast.tail(horizon), include_bounds
+        )
+        for period in daily_periods:
+            period_totals[period] = (cs_yhat[period - 1], cs_lower[period - 1], cs_upper[period - 1])
+        
+        if weekly_periods:
+            # Bin into 7-day weeks ending on the last observed date, so the
+            # weekly forecast starts the day after the history ends
+            weekly_data = (
+                product_data.set_index('ds')
+                .resample(pd.Timedelta(days=7), origin='end', closed='right', label='right')
+                .sum()
+                .reset_index()
+            )
+            
+            # Drop the oldest bin when it covers less than a full week of history
+            if weekly_data['ds'].iloc[0] - pd.Timedelta(days=6) < product_data['ds'].iloc[0]:
+                weekly_data = weekly_data.iloc[1:]
+            
+            weekly_model = _new_prophet_model(len(product_data), include_bounds)
+            weekly_model.weekly_seasonality = False
+            
+            logger.info("Training weekly Prophet model...")
+            weekly_model.fit(weekly_data.astype({'y': np.float64}))
+            
+            weekly_horizon = -(-max(weekly_periods) // 7)
+            weekly_future = weekly_model.make_future_dataframe(periods=weekly_horizon, freq='7D')
+            weekly_forecast = weekly_model.predict(weekly_future)
+            
+            cs_yhat, cs_lower, cs_upper = _cumulative_totals(
+                weekly_forecast.tail(weekly_horizon), include_bounds
+            )
+            for period in weekly_periods:
+                # Pro-rate the whole weeks covering the period, e.g. 13 weeks for 90 days
+                weeks = -(-period // 7)
+                scale = period / (weeks * 7)
+                period_totals[period] = (
+                    cs_yhat[weeks - 1] * scale,
+                    cs_lower[weeks - 1] * scale,
+                    cs_upper[weeks - 1] * scale
+                )
+        
+        # Generate forecasts for each period
+        forecasts = {}
+        
+        for period in forecast_periods:
+            # Calculate total forecasted quantity for the period
+            total_forecast, lower_bound, upper_bound = period_totals[period]
+            total_forecast = max(0, total_forecast)
+            
+            forecasts[f'forecast_{period}d'] = {
+                'value': round(total_forecast),
+                'lower_bound': max(0, round(lower_bound)),
+                'upper_bound': round(upper_bound)
+            }
+            
+            logger.info(f"{period}-day forecast: {round(total_forecast)} units")
+        
+        # Calculate model performance metrics from the history rows at the
+        # head of the forecast instead of predicting them again
+        y = product_data['y'].to_numpy(dtype=np.float32, copy=True)
+        in_sample_yhat = forecast['yhat'].iloc[:len(product_data)].to_numpy(dtype=np.float32, copy=True)
+        mae, mape = _stats_kernel(y, in_sample_yhat)
+        
+        # Determine trend status from the first 30 days of history and the last
+        # 30 days of the longest period, whichever horizon the daily model used
+        trend = forecast['trend'].to_numpy()
+        trend_horizon = max(forecast_periods)
+        if horizon >= trend_horizon:
+            end_trend = trend[-30:]
+        else:
+            trend_dates = pd.DataFrame({'ds': pd.date_range(
+                product_data['ds'].iloc[-1] + pd.Timedelta(days=trend_horizon - 29), periods=30, freq='D'
+            )})
+            end_trend = model.predict(trend_dates)['trend'].to_numpy()
+        recent_trend = end_trend.mean() - trend[:30].mean()
+        if recent_trend > 0.1:
+            trend_status = 'trending'
+        elif recent_trend < -0.1:
+            trend_status = 'declining'
+        else:
+            trend_status = 'stable'
+        
+        # Calculate confidence score based on model performance
+        confidence_score = max(0.3, min(0.95, 1 - (mape / 100)))
+        
+        result = {
+            'forecasts': forecasts,
+            'trend_status': trend_status,
+            'confidence_score': confidence_score,
+            'mae': mae,
+            'mape': mape
+        }
+        
+        logger.info(f"Model trained successfully. MAE: {mae:.2f}, MAPE: {mape:.2f}%")
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"Error in training/forecasting: {e}")
+        raise
+
+
+def _fit_one(product_id, product_info):
+    """
+    Train and forecast a single product; runs inside a joblib worker
+    
+    Args:
+        product_id (str): Product ID
+        product_info (dict): Cleaned data and name for the product
+        
+    Returns:
+        tuple: (product_id, forecast results or None, error or None)
+    """
+    # Worker processes never run the script's logging setup
+    configure_logging()
+    
+    try:
+        logger.info(f"Generating forecast for {product_info['product_name']}")
+        return product_id, train_and_forecast(product_info['data']), None
+    except Exception as e:
+        return product_id, None, e
@@ -10,35 +10,58 @@ Requirements:
 - prophet
 - psycopg2-binary (for PostgreSQL connection)
 - python-dotenv (for environment variables)
+- joblib (for fitting products in parallel)
+- statsforecast (default batch backend; Prophet is kept behind backend='prophet')
+- numba (for the outlier and error metric kernels)
+- cmdstanpy (Stan backend for Prophet; the compiled model is cached after first use)
 
-Install with: pip install pandas prophet psycopg2-binary python-dotenv
+Install with: pip install pandas prophet psycopg2-binary python-dotenv joblib statsforecast numba cmdstanpy
 """
 
 import pandas as pd
 import numpy as np
-from prophet import Prophet
 import psycopg2
+from joblib import Parallel, delayed
+from statsforecast import StatsForecast
+from statsforecast.models import AutoETS, Naive
 from datetime import datetime, timedelta
 import logging
+import csv
+import io
 import os
 from dotenv import load_dotenv
+from prophet_forecast_models import (
+    _cap_outliers, _fill_daily_gaps, _fit_one, _stats_kernel, configure_logging, naive_forecast, train_and_forecast
+)
 
 # Load environment variables
 load_dotenv()
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 logger = logging.getLogger(__name__)
 
+
 class ProphetForecaster:
-    def __init__(self, db_connection_string=None):
+    # Per-product fitting lives in prophet_forecast_models so joblib workers
+    # import it rather than receiving it pickled by value from this script
+    train_and_forecast = staticmethod(train_and_forecast)
+    naive_forecast = staticmethod(naive_forecast)
+    
+    def __init__(self, db_connection_string=None, backend='statsforecast'):
         """
         Initialize the Prophet Forecaster
         
         Args:
             db_connection_string (str): PostgreSQL connection string
+            backend (str): 'statsforecast' to batch-fit AutoETS over all products,
+                or 'prophet' to fit one Prophet model per product
         """
+        if backend not in ('statsforecast', 'prophet'):
+            raise ValueError(f"Unknown forecasting backend: {backend}")
+        
         self.db_connection_string = db_connection_string or os.getenv('DATABASE_URL')
+        self.backend = backend
         self.connection = None
         
     def connect_to_database(self):
@@ -66,15 +89,32 @@ class ProphetForecaster:
                 sd.product_id,
                 p.name as product_name,
                 sd.date,
-                sd.quantity_sold,
-                sd.unit_price
+                sd.quantity_sold
             FROM sales_data sd
             INNER JOIN products p ON sd.product_id = p.id
             WHERE sd.user_id = %s
-            ORDER BY p.name, sd.date
+            ORDER BY sd.product_id, sd.date
             """
             
-            df = pd.read_sql_query(query, self.connection, params=(user_id,))
+            columns = ['product_id', 'product_name', 'date', 'quantity_sold']
+            
+            # Read through a server-side cursor and build each chunk into a frame
+            # as it arrives, so only one chunk of raw row tuples is held at a time;
+            # dates are parsed once, in clean_and_prepare_data
+            frames = []
+            with self.connection.cursor(name='sales_data_cursor') as cursor:
+                cursor.itersize = 10000
+                cursor.execute(query, (user_id,))
+                while True:
+                    chunk = cursor.fetchmany(cursor.itersize)
+                    if not chunk:
+                        break
+                    frames.append(pd.DataFrame.from_records(chunk, columns=columns))
+            
+            if frames:
+                df = pd.concat(frames, ignore_index=True)
+            else:
+                df = pd.DataFrame(columns=columns)
             logger.info(f"Fetched {len(df)} sales records for user {user_id}")
             return df
             
@@ -95,41 +135,45 @@ class ProphetForecaster:
         cleaned_data = {}
         
         try:
-            # Group by product
-            for product_id, group in df.groupby('product_id'):
-                product_name = group['product_name'].iloc[0]
-                logger.info(f"Cleaning data for product: {product_name} (ID: {product_id})")
-                
-                # Prepare data for Prophet (requires 'ds' and 'y' columns)
-                product_data = group.copy()
-                product_data['ds'] = pd.to_datetime(product_data['date'])
-                product_data['y'] = product_data['quantity_sold']
-                
-                # Remove duplicates and sort by date
-                product_data = product_data.drop_duplicates(subset=['ds']).sort_values('ds')
-                
-                # Handle missing values
-                product_data['y'] = product_data['y'].fillna(0)
-                
+            # Prepare data for Prophet (requires 'ds' and 'y' columns), carrying
+            # only the columns needed for deduplication and sorting
+            frame = pd.DataFrame({
+                'product_id': df['product_id'],
+                'ds': pd.to_datetime(df['date'], format='%Y-%m-%d', cache=True),
+                'y': df['quantity_sold']
+            })
+            
+            # Remove duplicates and sort by date within each product
+            frame = frame.drop_duplicates(subset=['product_id', 'ds']).sort_values(['product_id', 'ds'])
+            
+            # Handle missing values; float32 halves the memory the cleaning and
+            # metric passes touch, models upcast to float64 when they fit
+            y = frame['y'].fillna(0).to_numpy(dtype=np.float32, copy=True)
+            ds = frame['ds'].to_numpy()
+            
+            # Cap outliers (values beyond 3 standard deviations) for all products at once;
+            # rows are sorted by product so each product is a contiguous run
+            product_ids = frame['product_id'].to_numpy()
+            starts = np.flatnonzero(np.r_[True, product_ids[1:] != product_ids[:-1]])
+            _cap_outliers(y, starts)
+            
+            ends = np.r_[starts[1:], len(y)]
+            product_names = df.loc[frame.index[starts], 'product_name'].to_numpy()
+            
+            for product_id, product_name, start, end in zip(product_ids[starts], product_names, starts, ends):
                 # Ensure we have enough data points (Prophet needs at least 2)
-                if len(product_data) < 2:
+                if end - start < 2:
                     logger.warning(f"Insufficient data for {product_name}. Skipping.")
                     continue
                 
-                # Remove outliers (values beyond 3 standard deviations)
-                mean_sales = product_data['y'].mean()
-                std_sales = product_data['y'].std()
-                if std_sales > 0:
-                    outlier_threshold = mean_sales + 3 * std_sales
-                    product_data.loc[product_data['y'] > outlier_threshold, 'y'] = outlier_threshold
-                
-                # Store cleaned data
+                # Store cleaned data as a two-column frame over views of the
+                # sorted arrays, without copying each product's rows
                 cleaned_data[product_id] = {
-                    'data': product_data[['ds', 'y']],
+                    'data': pd.DataFrame({'ds': ds[start:end], 'y': y[start:end]}, copy=False),
                     'product_name': product_name
                 }
                 
-                logger.info(f"Cleaned data for {product_name}: {len(product_data)} records")
+                logger.info(f"Cleaned data for {product_name}: {end - start} records")
                 
         except Exception as e:
             logger.error(f"Error cleaning data: {e}")
@@ -137,140 +181,165 @@ class ProphetForecaster:
             
         return cleaned_data
     
-    def train_and_forecast(self, product_data, forecast_periods=[7, 30, 90, 365]):
+    @staticmethod
+    def train_and_forecast_batch(cleaned_data, forecast_periods=[7, 30, 90, 365]):
         """
-        Train Prophet model and generate forecasts
+        Fit AutoETS on all products in a single StatsForecast call
         
         Args:
-            product_data (pd.DataFrame): Cleaned sales data with 'ds' and 'y' columns
+            cleaned_data (dict): Output of clean_and_prepare_data
             forecast_periods (list): List of periods to forecast
             
         Returns:
-            dict: Dictionary containing forecasts and model performance metrics
+            list: (product_id, forecast results or None, error or None) tuples,
+                in the same shape as the Prophet path
         """
         try:
-            # Initialize Prophet model with reasonable parameters
-            model = Prophet(
-                daily_seasonality=True,
-                weekly_seasonality=True,
-                yearly_seasonality=True if len(product_data) > 365 else False,
-                seasonality_mode='multiplicative',
-                changepoint_prior_scale=0.1,  # Controls flexibility of trend
-                seasonality_prior_scale=10.0,  # Controls flexibility of seasonality
-                interval_width=0.8  # Uncertainty interval width
-            )
+            # Build one long dataframe with unique_id/ds/y columns. StatsForecast
+            # treats each row as one step, so days without sales are filled with
+            # 0 to make horizons count days and season_length line up with weekdays
+            long_df = pd.concat(
+                [
+                    _fill_daily_gaps(info['data']).assign(unique_id=product_id)
+                    for product_id, info in cleaned_data.items()
+                ],
+                ignore_index=True
+            )[['unique_id', 'ds', 'y']].astype({'y': np.float64})
             
-            # Fit the model
-            logger.info("Training Prophet model...")
-            model.fit(product_data)
+            horizon = max(forecast_periods)
+            # Series AutoETS cannot fit (e.g. very short histories) fall back to
+            # a naive forecast instead of failing the whole batch
+            sf = StatsForecast(
+                models=[AutoETS(season_length=7)],
+                freq='D',
+                n_jobs=-1,
+                fallback_model=Naive()
+            )
+            logger.info(f"Training AutoETS on {len(cleaned_data)} products...")
+            forecast = sf.forecast(df=long_df, h=horizon, level=[80], fitted=True)
+            fitted = sf.forecast_fitted_values()
             
-            # Generate forecasts for each period
-            forecasts = {}
+            # Older statsforecast versions return unique_id as the index
+            if 'unique_id' not in forecast.columns:
+                forecast = forecast.reset_index()
+            if 'unique_id' not in fitted.columns:
+                fitted = fitted.reset_index()
             
-            for period in forecast_periods:
-                # Create future dataframe
-                future = model.make_future_dataframe(periods=period, freq='D')
+        except Exception as e:
+            logger.error(f"Error in batch training/forecasting: {e}")
+            raise
+        
+        fitted_by_product = dict(tuple(fitted.groupby('unique_id', sort=False)))
+        results = []
+        
+        for product_id, product_forecast in forecast.groupby('unique_id', sort=False):
+            try:
+                # Cumulative totals at each horizon, e.g. row 6 is the 7-day total
+                cs_yhat = product_forecast['AutoETS'].cumsum().to_numpy()
+                cs_lower = product_forecast['AutoETS-lo-80'].cumsum().to_numpy()
+                cs_upper = product_forecast['AutoETS-hi-80'].cumsum().to_numpy()
                 
-                # Generate forecast
-                forecast = model.predict(future)
+                forecasts = {}
+                for period in forecast_periods:
+                    forecasts[f'forecast_{period}d'] = {
+                        'value': round(max(0, cs_yhat[period - 1])),
+                        'lower_bound': max(0, round(cs_lower[period - 1])),
+                        'upper_bound': round(cs_upper[period - 1])
+                    }
                 
-                # Get the forecasted values for the future period
-                future_forecast = forecast.tail(period)
+                # Calculate model performance metrics, skipping steps without a
+                # fitted value (the Naive fallback has none for the first step)
+                in_sample = fitted_by_product[product_id]
+                y = in_sample['y'].to_numpy(dtype=np.float32, copy=True)
+                yhat = in_sample['AutoETS'].to_numpy(dtype=np.float32, copy=True)
+                finite = np.isfinite(yhat)
+                y, yhat = y[finite], yhat[finite]
+                if len(y):
+                    mae, mape = _stats_kernel(y, yhat)
+                else:
+                    mae = mape = float('nan')
                 
-                # Calculate total forecasted quantity for the period
-                total_forecast = max(0, future_forecast['yhat'].sum())
+                # Determine trend status from the start of history to the end of the forecast
+                recent_trend = product_forecast['AutoETS'].to_numpy()[-30:].mean() - yhat[:30].mean()
+                if recent_trend > 0.1:
+                    trend_status = 'trending'
+                elif recent_trend < -0.1:
+                    trend_status = 'declining'
+                else:
+                    trend_status = 'stable'
                 
-                # Get confidence intervals
-                lower_bound = future_forecast['yhat_lower'].sum()
-                upper_bound = future_forecast['yhat_upper'].sum()
+                if len(y):
+                    confidence_score = max(0.3, min(0.95, 1 - (mape / 100)))
+                else:
+                    confidence_score = 0.3
                 
-                forecasts[f'forecast_{period}d'] = {
-                    'value': round(total_forecast),
-                    'lower_bound': max(0, round(lower_bound)),
-                    'upper_bound': round(upper_bound)
-                }
+                results.append((product_id, {
+                    'forecasts': forecasts,
+                    'trend_status': trend_status,
+                    'confidence_score': confidence_score,
+                    'mae': mae,
+                    'mape': mape
+                }, None))
                 
-                logger.info(f"{period}-day forecast: {round(total_forecast)} units")
-            
-            # Calculate model performance metrics
-            in_sample_forecast = model.predict(product_data)
-            mae = np.mean(np.abs(product_data['y'] - in_sample_forecast['yhat']))
-            mape = np.mean(np.abs((product_data['y'] - in_sample_forecast['yhat']) / 
-                                 np.maximum(product_data['y'], 1))) * 100
-            
-            # Determine trend status
-            recent_trend = forecast.tail(30)['trend'].mean() - forecast.head(30)['trend'].mean()
-            if recent_trend > 0.1:
-                trend_status = 'trending'
-            elif recent_trend < -0.1:
-                trend_status = 'declining'
-            else:
-                trend_status = 'stable'
-            
-            # Calculate confidence score based on model performance
-            confidence_score = max(0.3, min(0.95, 1 - (mape / 100)))
-            
-            result = {
-                'forecasts': forecasts,
-                'trend_status': trend_status,
-                'confidence_score': confidence_score,
-                'mae': mae,
-                'mape': mape
-            }
-            
-            logger.info(f"Model trained successfully. MAE: {mae:.2f}, MAPE: {mape:.2f}%")
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"Error in training/forecasting: {e}")
-            raise
+            except Exception as e:
+                results.append((product_id, None, e))
+        
+        return results
     
-    def save_forecasts_to_database(self, user_id, product_id, forecasts_data):
+    def save_forecasts_to_database(self, user_id, forecasts_by_product):
         """
-        Save forecast results to database
+        Save forecast results to database in a single transaction
         
         Args:
             user_id (str): User ID
-            product_id (str): Product ID
-            forecasts_data (dict): Forecast results from train_and_forecast
+            forecasts_by_product (dict): Product ID mapped to forecast results
+                from train_and_forecast
         """
         try:
             cursor = self.connection.cursor()
             
-            # Delete existing forecasts for this product
+            generated_at = datetime.now()
+            expires_at = generated_at + timedelta(hours=24)
+            
+            rows = [
+                (
+                    user_id,
+                    product_id,
+                    forecasts_data['forecasts']['forecast_7d']['value'],
+                    forecasts_data['forecasts']['forecast_30d']['value'],
+                    forecasts_data['forecasts']['forecast_90d']['value'],
+                    forecasts_data['forecasts']['forecast_365d']['value'],
+                    forecasts_data['trend_status'],
+                    forecasts_data['confidence_score'],
+                    generated_at,
+                    expires_at
+                )
+                for product_id, forecasts_data in forecasts_by_product.items()
+            ]
+            
+            # Delete existing forecasts for these products in one statement
             delete_query = """
             DELETE FROM forecast_data 
-            WHERE user_id = %s AND product_id = %s
+            WHERE user_id = %s AND product_id = ANY(%s::uuid[])
             """
-            cursor.execute(delete_query, (user_id, product_id))
+            cursor.execute(delete_query, (user_id, list(forecasts_by_product)))
+            
+            # Stream new forecasts in with COPY as CSV on the same transaction
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
             
-            # Insert new forecast
-            insert_query = """
-            INSERT INTO forecast_data (
+            copy_query = """
+            COPY forecast_data (
                 user_id, product_id, forecast_7d, forecast_30d, 
                 forecast_90d, forecast_365d, trend_status, confidence_score,
                 generated_at, expires_at
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ) FROM STDIN WITH (FORMAT csv)
             """
-            
-            expires_at = datetime.now() + timedelta(hours=24)
-            
-            cursor.execute(insert_query, (
-                user_id,
-                product_id,
-                forecasts_data['forecasts']['forecast_7d']['value'],
-                forecasts_data['forecasts']['forecast_30d']['value'],
-                forecasts_data['forecasts']['forecast_90d']['value'],
-                forecasts_data['forecasts']['forecast_365d']['value'],
-                forecasts_data['trend_status'],
-                forecasts_data['confidence_score'],
-                datetime.now(),
-                expires_at
-            ))
+            cursor.copy_expert(copy_query, buffer)
             
             self.connection.commit()
-            logger.info(f"Saved forecasts for product {product_id}")
+            logger.info(f"Saved forecasts for {len(rows)} products")
             
         except Exception as e:
             logger.error(f"Error saving forecasts: {e}")
@@ -310,21 +379,33 @@ class ProphetForecaster:
             total_products = len(cleaned_data)
             successful_forecasts = 0
             
-            for product_id, product_info in cleaned_data.items():
-                try:
-                    logger.info(f"Generating forecast for {product_info['product_name']}")
-                    
-                    # Train model and generate forecasts
-                    forecast_results = self.train_and_forecast(product_info['data'])
-                    
-                    # Save to database
-                    self.save_forecasts_to_database(user_id, product_id, forecast_results)
-                    
-                    successful_forecasts += 1
-                    
-                except Exception as e:
-                    logger.error(f"Failed to generate forecast for product {product_id}: {e}")
+            if self.backend == 'prophet':
+                # Compile the metric kernel once here so every worker loads it
+                # from numba's on-disk cache instead of compiling it again; call
+                # sites all pass writable float32 copies to match this signature
+                _stats_kernel(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.float32))
+                
+                # Train models in parallel across CPU cores; loky keeps workers
+                # alive between tasks so each worker's Prophet template is reused
+                results = Parallel(n_jobs=-1, backend='loky', batch_size=1)(
+                    delayed(_fit_one)(product_id, product_info)
+                    for product_id, product_info in cleaned_data.items()
+                )
+            else:
+                results = self.train_and_forecast_batch(cleaned_data)
+            
+            # Collect successful forecasts and write them on the main thread's connection
+            forecasts_by_product = {}
+            for product_id, forecast_results, error in results:
+                if error is not None:
+                    logger.error(f"Failed to generate forecast for product {product_id}: {error}")
                     continue
+                
+                forecasts_by_product[product_id] = forecast_results
+            
+            if forecasts_by_product:
+                self.save_forecasts_to_database(user_id, forecasts_by_product)
+                successful_forecasts = len(forecasts_by_product)
             
             logger.info(f"Forecasting completed. {successful_forecasts}/{total_products} products processed successfully")
             
@@ -338,18 +419,25 @@ class ProphetForecaster:
 def main():
     """
     Main function to run the forecasting script
-    Usage: python prophet_forecast_script.py [user_id]
+    Usage: python prophet_forecast_script.py <user_id> [--backend statsforecast|prophet]
     """
+    import argparse
     import sys
     
-    if len(sys.argv) != 2:
-        print("Usage: python prophet_forecast_script.py <user_id>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Generate sales forecasts for a user")
+    parser.add_argument('user_id', help="User ID to generate forecasts for")
+    parser.add_argument(
+        '--backend',
+        choices=['statsforecast', 'prophet'],
+        default=os.getenv('FORECAST_BACKEND', 'statsforecast'),
+        help="Forecasting backend (default: $FORECAST_BACKEND or statsforecast)"
+    )
+    args = parser.parse_args()
     
-    user_id = sys.argv[1]
+    user_id = args.user_id
     
     try:
-        forecaster = ProphetForecaster()
+        forecaster = ProphetForecaster(backend=args.backend)
         forecaster.run_forecasting_for_user(user_id)
         print(f"Forecasting completed successfully for user {user_id}")
     except Exception as e: